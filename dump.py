@@ -3,6 +3,9 @@ import struct
 import os
 import codecs
 import re
+import functools
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 
 # --- CONFIGURATION ---
 rom_filename = "Pia Carrot e Youkoso!! 3.3 (Japan).gba"
@@ -20,8 +23,14 @@ pointer_tables = [
 
 terminator = b'\x00'
 newline_char = b'\x0a'
+POINTER_STRUCT = struct.Struct('<I')  # little-endian 32-bit GBA pointer
 
 OFFSET_MIN_VALID = 0x0010C000  # strings abaixo desse offset serão ignoradas
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Output layout of each entry; the text is either the string or a duplicate marker
+STRING_BLOCK_FORMAT = "<STRING %04d>\nPOINTER_OFFSET: 0x%08X\nTEXT_OFFSET: 0x%08X\n%s\n\n"
+DUPLICATE_MARKER_FORMAT = "[DUPLICATE OF <STRING %04d>]"
+SCAN_WORKERS = os.cpu_count() or 1  # processes validating strings in scan mode, 1 = no extra processes
 
 def custom_sjis_error_handler(e):
     if not isinstance(e, UnicodeDecodeError):
@@ -32,10 +41,14 @@ def custom_sjis_error_handler(e):
 
 codecs.register_error("custom_sjis", custom_sjis_error_handler)
 
-def read_string_from(data, offset, terminator_byte):
+def read_string_from(data, offset, terminator_byte, max_bytes=None):
     if offset >= len(data):
         return None
-    end_index = data.find(terminator_byte, offset)
+    if max_bytes is None:
+        end_index = data.find(terminator_byte, offset)
+    else:
+        # Stop looking once the string is already too long to be kept
+        end_index = data.find(terminator_byte, offset, offset + max_bytes + 1)
     if end_index == -1:
         return None
     chunk = data[offset:end_index]
@@ -53,6 +66,7 @@ MIN_PRINTABLE_FRAC = 0.55
 MIN_JP_CHARS_OVERRIDE = 2
 MIN_LATIN_DIGITS = 3
 MAX_TOTAL_LENGTH = 1024
+MAX_STRING_BYTES = MAX_TOTAL_LENGTH * 2  # each decoded char takes at most 2 bytes
 MAX_CONTROL_CHAR_FRAC = 0.05
 MIN_UNIQUE_CHARS = 6
 MIN_NON_JP_LENGTH = 5
@@ -70,6 +84,25 @@ PRINTABLE_RE = re.compile(
 )
 REPLACEMENT_TOKEN_RE = re.compile(r'<\$\w{2,}\$>')
 LATIN_DIGIT_RE = re.compile(r'[A-Za-z0-9]')
+START_JP_LATIN_RE = re.compile(r'^[\u3040-\u30FF\u4E00-\u9FFF][A-Za-z0-9]')
+START_LATIN_PREFIX_RE = re.compile(r'^[A-Za-z0-9]{1,3}[^A-Za-z0-9]')
+
+# One class letter per BMP codepoint, so is_valid_string can classify a whole
+# string with a single str.translate and count each class with str.count
+CLASS_JAPANESE = 'j'
+CLASS_LATIN_DIGIT = 'l'
+CLASS_PRINTABLE = 'p'  # printable, but neither Japanese nor latin/digit
+CLASS_CONTROL = 'c'
+CLASS_OTHER = 'o'
+
+def classify_char(c):
+    if JAPANESE_RE.match(c): return CLASS_JAPANESE
+    if LATIN_DIGIT_RE.match(c): return CLASS_LATIN_DIGIT
+    if PRINTABLE_RE.match(c): return CLASS_PRINTABLE
+    if ord(c) < 0x20: return CLASS_CONTROL
+    return CLASS_OTHER
+
+CHAR_CLASS_TABLE = ''.join(classify_char(chr(i)) for i in range(0x10000))
 
 def is_valid_string(text):
     if not text:
@@ -79,131 +112,152 @@ def is_valid_string(text):
     if len(text) > MAX_TOTAL_LENGTH:
         return False
 
-    repl_tokens = REPLACEMENT_TOKEN_RE.findall(text)
+    # Replacement tokens all start with '<$', so most strings never need the regex
+    repl_tokens = REPLACEMENT_TOKEN_RE.findall(text) if '<$' in text else []
     repl_frac = (len(''.join(repl_tokens)) / max(1, len(text)))
     repl_token_count = len(repl_tokens)
 
-    printable_chars = PRINTABLE_RE.findall(text)
-    printable_frac = len(printable_chars) / max(1, len(text))
-
-    jp_chars = JAPANESE_RE.findall(text)
-    jp_count = len(jp_chars)
-    latin_digits_count = len(LATIN_DIGIT_RE.findall(text))
-
-    control_chars = [c for c in text if ord(c) < 0x20 and c not in "\n\r\t"]
-    control_frac = len(control_chars) / max(1, len(text))
-
-    unique_chars = set(text)
-
-    def is_repeated_pattern(s):
-        if len(set(s)) == 1:
-            return True
-        for size in range(1, 6):
-            if len(s) > size and len(s) % size == 0:
-                pattern = s[:size]
-                if pattern * (len(s) // size) == s:
-                    return True
-        return False
+    # Codepoints outside the table are left untouched and fall in no class
+    char_classes = text.translate(CHAR_CLASS_TABLE)
+    jp_count = char_classes.count(CLASS_JAPANESE)
+    latin_digits_count = char_classes.count(CLASS_LATIN_DIGIT)
+    printable_count = jp_count + latin_digits_count + char_classes.count(CLASS_PRINTABLE)
+    printable_frac = printable_count / max(1, len(text))
 
-    def is_single_japanese_char_repetition(s):
-        if len(s) == 0:
-            return False
-        unique_chars_local = set(s)
-        if len(unique_chars_local) == 1:
-            c = unique_chars_local.pop()
-            return bool(JAPANESE_RE.fullmatch(c))
-        return False
+    control_frac = char_classes.count(CLASS_CONTROL) / max(1, len(text))
 
     if control_frac > MAX_CONTROL_CHAR_FRAC: return False
     if jp_count < MIN_JP_CHARS_OVERRIDE and latin_digits_count < MIN_LATIN_DIGITS: return False
     if printable_frac < MIN_PRINTABLE_FRAC: return False
     if repl_token_count > 0 and repl_frac > MAX_REPLACEMENT_FRAC: return False
     if jp_count >= MIN_JP_CHARS_OVERRIDE and repl_token_count < (len(text) * 0.5): return True
-    if jp_count == 0 and len(printable_chars) < MIN_NON_JP_LENGTH: return False
+    if jp_count == 0 and printable_count < MIN_NON_JP_LENGTH: return False
     if jp_count == 0 and latin_digits_count < 3: return False
-    if is_repeated_pattern(text) and not is_single_japanese_char_repetition(text): return False
+    unique_chars = set(text)
+    # Reject short repeating patterns (up to 5 chars), except a single repeated Japanese char.
+    # A pattern of n chars has at most n unique chars, so most strings skip this entirely.
+    if len(unique_chars) == 1:
+        if not JAPANESE_RE.fullmatch(text[0]): return False
+    elif len(unique_chars) <= 5:
+        for size in range(len(unique_chars), 6):
+            if len(text) > size and len(text) % size == 0 and text[:size] * (len(text) // size) == text:
+                return False
     start_sample = text[:6]
-    if re.match(r'^[\u3040-\u30FF\u4E00-\u9FFF][A-Za-z0-9]', start_sample): return False
-    if re.match(r'^[A-Za-z0-9]{1,3}[^A-Za-z0-9]', start_sample) and len(text) < 8: return False
+    if START_JP_LATIN_RE.match(start_sample): return False
+    if START_LATIN_PREFIX_RE.match(start_sample) and len(text) < 8: return False
 
     return True
 
+# Reads and validates the string at file_offset of the loaded ROM, once per offset
+@functools.lru_cache(maxsize=None)
+def validated_string(file_offset):
+    text_string = read_string_from(rom_data, file_offset, terminator, MAX_STRING_BYTES)
+    return text_string if is_valid_string(text_string) else None
+
+# Scan-mode worker processes map the ROM read-only instead of each getting a copy of it
+def init_scan_worker(filename):
+    global rom_data
+    with open(filename, 'rb') as f:
+        rom_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def validate_offsets(offsets):
+    return {file_offset: validated_string(file_offset) for file_offset in offsets}
+
 # ---------------------- main ---------------------- #
-if not os.path.exists(rom_filename):
-    print(f"ERROR: ROM file '{rom_filename}' not found.")
-else:
-    with open(rom_filename, 'rb') as f:
-        rom_data = f.read()
-
-    print(f"Extracting text from ROM '{rom_filename}' to '{output_filename}' (mode={mode})...")
-
-    with open(output_filename, 'w', encoding='utf-8') as output_file:
-        string_id_counter = 0
-        # NEW: Dictionary to track already processed text offsets: {text_offset: original_string_id}
-        seen_text_offsets = {} 
-
-        if mode == "tables":
-            for table_info in pointer_tables:
-                start_offset = table_info['start']
-                end_offset = table_info['end']
-                table_type = table_info['type']
-
-                current_offset = start_offset
-                entry_size = 8 if table_type == 'standard' else 16
-
-                while current_offset < end_offset:
-                    pointer_bytes = rom_data[current_offset:current_offset+4]
-                    if len(pointer_bytes) < 4:
-                        break
-                    address = struct.unpack('<I', pointer_bytes)[0]
-
-                    if 0x08000000 <= address < 0x09000000:
-                        file_offset = address - 0x08000000
-                        if file_offset < len(rom_data) and file_offset >= OFFSET_MIN_VALID:
-                            text_string = read_string_from(rom_data, file_offset, terminator)
-                            if is_valid_string(text_string):
-                                # NEW: Check for duplicates
-                                if file_offset in seen_text_offsets:
-                                    original_id = seen_text_offsets[file_offset]
-                                    output_block = f"<STRING {string_id_counter:04}>\nPOINTER_OFFSET: 0x{current_offset:08X}\nTEXT_OFFSET: 0x{file_offset:08X}\n[DUPLICATE OF <STRING {original_id:04}>]\n\n"
-                                else:
-                                    # NEW: Add new, valid text to our tracking dictionary
-                                    seen_text_offsets[file_offset] = string_id_counter
-                                    output_block = f"<STRING {string_id_counter:04}>\nPOINTER_OFFSET: 0x{current_offset:08X}\nTEXT_OFFSET: 0x{file_offset:08X}\n{text_string}\n\n"
+if __name__ == "__main__":
+    if not os.path.exists(rom_filename):
+        print(f"ERROR: ROM file '{rom_filename}' not found.")
+    else:
+        with open(rom_filename, 'rb') as f:
+            rom_data = f.read()
+
+        print(f"Extracting text from ROM '{rom_filename}' to '{output_filename}' (mode={mode})...")
+
+        # A 1MB buffer keeps the many small per-entry writes from each reaching the OS
+        with open(output_filename, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE) as output_file:
+            string_id_counter = 0
+            # NEW: Dictionary to track already processed text offsets: {text_offset: duplicate marker for its string}
+            seen_text_offsets = {} 
+
+            if mode == "tables":
+                for table_info in pointer_tables:
+                    start_offset = table_info['start']
+                    end_offset = table_info['end']
+                    table_type = table_info['type']
+
+                    current_offset = start_offset
+                    entry_size = 8 if table_type == 'standard' else 16
+
+                    while current_offset < end_offset:
+                        if current_offset + POINTER_STRUCT.size > len(rom_data):
+                            break
+                        address = POINTER_STRUCT.unpack_from(rom_data, current_offset)[0]
+
+                        if 0x08000000 <= address < 0x09000000:
+                            file_offset = address - 0x08000000
+                            if file_offset < len(rom_data) and file_offset >= OFFSET_MIN_VALID:
+                                text_string = validated_string(file_offset)
+                                if text_string is not None:
+                                    # NEW: Check for duplicates
+                                    if file_offset in seen_text_offsets:
+                                        output_block = STRING_BLOCK_FORMAT % (string_id_counter, current_offset, file_offset, seen_text_offsets[file_offset])
+                                    else:
+                                        # NEW: Add new, valid text to our tracking dictionary
+                                        seen_text_offsets[file_offset] = DUPLICATE_MARKER_FORMAT % string_id_counter
+                                        output_block = STRING_BLOCK_FORMAT % (string_id_counter, current_offset, file_offset, text_string)
                                 
-                                output_file.write(output_block)
-                                string_id_counter += 1
-                    current_offset += entry_size
-
-        elif mode == "scan":
-            rom_size = len(rom_data)
-            # NEW: Loop through all potential pointers first to build a list
-            all_pointers = []
-            for ptr_offset in range(0, rom_size - 4, 4):
-                address = struct.unpack('<I', rom_data[ptr_offset:ptr_offset+4])[0]
-                if 0x08000000 <= address < 0x09000000:
-                    file_offset = address - 0x08000000
-                    if 0 <= file_offset < rom_size and file_offset >= OFFSET_MIN_VALID:
+                                    output_file.write(output_block)
+                                    string_id_counter += 1
+                        current_offset += entry_size
+
+            elif mode == "scan":
+                rom_size = len(rom_data)
+                # NEW: Loop through all potential pointers first to build a list
+                all_pointers = []
+                # Pointers on the GBA are word-aligned, so only 4-byte aligned words are checked.
+                # A ROM pointer always has 0x08 as its top byte, so slice out the top byte
+                # of every little-endian word and let bytes.find jump between candidates
+                # instead of unpacking all ~2M words one by one. That rejects ~255/256 of the
+                # words in C; only the survivors get the exact range check below.
+                top_bytes = rom_data[3:rom_size - 1:4]
+                index = top_bytes.find(b'\x08')
+                while index != -1:
+                    ptr_offset = index * 4
+                    file_offset = POINTER_STRUCT.unpack_from(rom_data, ptr_offset)[0] - 0x08000000
+                    if OFFSET_MIN_VALID <= file_offset < rom_size:
                         all_pointers.append({'ptr_offset': ptr_offset, 'file_offset': file_offset})
-            
-            # NEW: Now process the found pointers
-            for pointer_info in all_pointers:
-                ptr_offset = pointer_info['ptr_offset']
-                file_offset = pointer_info['file_offset']
-                
-                if file_offset in seen_text_offsets:
-                    # This is a duplicate pointer
-                    original_id = seen_text_offsets[file_offset]
-                    output_block = f"<STRING {string_id_counter:04}>\nPOINTER_OFFSET: 0x{ptr_offset:08X}\nTEXT_OFFSET: 0x{file_offset:08X}\n[DUPLICATE OF <STRING {original_id:04}>]\n\n"
-                    output_file.write(output_block)
-                    string_id_counter += 1
+                    index = top_bytes.find(b'\x08', index + 1)
+
+                # Many pointers share a target, so read and validate each text offset only once
+                unique_offsets = sorted({pointer_info['file_offset'] for pointer_info in all_pointers})
+                if SCAN_WORKERS > 1:
+                    # Validations are independent, so spread them over several processes
+                    chunk_size = max(1, -(-len(unique_offsets) // (SCAN_WORKERS * 4)))
+                    offset_chunks = [unique_offsets[i:i + chunk_size] for i in range(0, len(unique_offsets), chunk_size)]
+                    with ProcessPoolExecutor(SCAN_WORKERS, initializer=init_scan_worker, initargs=(rom_filename,)) as executor:
+                        validated_strings = {}
+                        for chunk_results in executor.map(validate_offsets, offset_chunks):
+                            validated_strings.update(chunk_results)
                 else:
-                    # This is a new text offset, check if the string is valid
-                    text_string = read_string_from(rom_data, file_offset, terminator)
-                    if is_valid_string(text_string):
-                        seen_text_offsets[file_offset] = string_id_counter
-                        output_block = f"<STRING {string_id_counter:04}>\nPOINTER_OFFSET: 0x{ptr_offset:08X}\nTEXT_OFFSET: 0x{file_offset:08X}\n{text_string}\n\n"
+                    validated_strings = validate_offsets(unique_offsets)
+                valid_strings = {file_offset: text_string for file_offset, text_string in validated_strings.items() if text_string is not None}
+
+                # NEW: Now process the found pointers
+                for pointer_info in all_pointers:
+                    ptr_offset = pointer_info['ptr_offset']
+                    file_offset = pointer_info['file_offset']
+                
+                    if file_offset in seen_text_offsets:
+                        # This is a duplicate pointer
+                        output_block = STRING_BLOCK_FORMAT % (string_id_counter, ptr_offset, file_offset, seen_text_offsets[file_offset])
+                        output_file.write(output_block)
+                        string_id_counter += 1
+                    elif file_offset in valid_strings:
+                        # This is a new, valid text offset
+                        text_string = valid_strings[file_offset]
+                        seen_text_offsets[file_offset] = DUPLICATE_MARKER_FORMAT % string_id_counter
+                        output_block = STRING_BLOCK_FORMAT % (string_id_counter, ptr_offset, file_offset, text_string)
                         output_file.write(output_block)
                         string_id_counter += 1
 
-    print(f"Extraction complete! Total entries (including duplicates): {string_id_counter}")
\ No newline at end of file
+        print(f"Extraction complete! Total entries (including duplicates): {string_id_counter}")
\ No newline at end of file
@@ -1,7 +1,9 @@
 # repack_pia_carrot.py
 import struct
+import bisect
 import os
 import re
+import mmap
 
 # --- CONFIGURATION ---
 rom_filename = "Pia Carrot e Youkoso!! 3.3 (Japan).gba"
@@ -16,87 +18,93 @@ ROM_END_OFFSET = 0x7FFFFF # The absolute end of the usable ROM space
 # --- GAME-SPECIFIC BYTES ---
 terminator = b'\x00'
 newline_char = b'\x0a'
+POINTER_STRUCT = struct.Struct('<I')  # little-endian 32-bit GBA pointer
 
 # This dictionary will map our text tags back to their original bytes
 TAG_MAP = {
     # Add any special named tags here if you find them, e.g.,
     # '[PLAYER_NAME]': b'\x02\x01'
 }
+
+# This regex will find both custom <$HEX$> tags and named [TAG] tags in a single pass.
+# Named tags are tried longest first, so a tag that is a prefix of another never wins.
+HEX_TAG_PATTERN = r"<\$\s*[0-9A-F\s]+\s*\$>"
+NAMED_TAG_PATTERNS = [re.escape(k) for k in sorted(TAG_MAP, key=len, reverse=True)]
+TAG_PATTERN = re.compile("(" + "|".join([HEX_TAG_PATTERN] + NAMED_TAG_PATTERNS) + ")")
 # ---------------------------------
 
 def parse_text_file(filename):
     """Reads the formatted text file and parses it into a list of entries."""
     print(f"Reading and parsing '{filename}'...")
     entries = []
-    with open(filename, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Regex to find each block, capturing ID, POINTER_OFFSET, TEXT_OFFSET and the text content
+    # Regex to find each block, capturing ID, POINTER_OFFSET, TEXT_OFFSET and the text content.
+    # It runs over the raw bytes so only the text itself gets decoded; lines may end in
+    # \r\n if the file was edited on Windows.
     pattern = re.compile(
-        r"<STRING (\d+?)>\n"
-        r"POINTER_OFFSET: 0x([0-9A-F]+)\n"
-        r"TEXT_OFFSET: 0x([0-9A-F]+)\n"
-        r"([\s\S]*?)\n\n",
+        rb"<STRING (\d+?)>\r?\n"
+        rb"POINTER_OFFSET: 0x([0-9A-F]+)\r?\n"
+        rb"TEXT_OFFSET: 0x([0-9A-F]+)\r?\n"
+        rb"([\s\S]*?)\r?\n\r?\n",
         re.MULTILINE
     )
     # Regex for duplicate entries
-    duplicate_pattern = re.compile(r"\[DUPLICATE OF <STRING (\d+)>\]")
-
-    for match in pattern.finditer(content):
-        entry_id = int(match.group(1))
-        pointer_offset = int(match.group(2), 16)
-        text_offset = int(match.group(3), 16)
-        text = match.group(4)
-
-        duplicate_match = duplicate_pattern.match(text)
-        if duplicate_match:
-            original_id = int(duplicate_match.group(1))
-            entries.append({
-                "id": entry_id,
-                "pointer_offset": pointer_offset,
-                "is_duplicate": True,
-                "original_id": original_id
-            })
-        else:
-            entries.append({
-                "id": entry_id,
-                "pointer_offset": pointer_offset,
-                "original_text_offset": text_offset,
-                "is_duplicate": False,
-                "text": text
-            })
-            
+    duplicate_pattern = re.compile(rb"\[DUPLICATE OF <STRING (\d+)>\]")
+
+    # mmap can't map an empty file, which dump.py writes when no string passes its filters
+    if os.path.getsize(filename) > 0:
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            for match in pattern.finditer(content):
+                entry_id = int(match.group(1))
+                pointer_offset = int(match.group(2), 16)
+                text_offset = int(match.group(3), 16)
+                text_bytes = match.group(4)
+
+                duplicate_match = duplicate_pattern.match(text_bytes)
+                if duplicate_match:
+                    original_id = int(duplicate_match.group(1))
+                    entries.append({
+                        "id": entry_id,
+                        "pointer_offset": pointer_offset,
+                        "is_duplicate": True,
+                        "original_id": original_id
+                    })
+                else:
+                    entries.append({
+                        "id": entry_id,
+                        "pointer_offset": pointer_offset,
+                        "original_text_offset": text_offset,
+                        "is_duplicate": False,
+                        # Same newline handling as text mode: \r\n and a lone \r both become \n
+                        "text": text_bytes.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+                    })
+
     print(f"Found {len(entries)} total entries in the source file.")
     return entries
 
 def encode_string(text_string):
     """Encodes a string, converting tags into bytes."""
-    # This regex will find both custom <$HEX$> tags and named [TAG] tags
-    hex_tag_pattern = r"<\$\s*([0-9A-F\s]+)\s*\$>"
-    named_tag_pattern = '|'.join(re.escape(k) for k in TAG_MAP.keys())
-    combined_pattern = re.compile(f"({hex_tag_pattern}|{named_tag_pattern})")
-
     # Replace text newlines with the game's newline byte
     processed_text = text_string.replace('\n', chr(newline_char[0]))
     
-    parts = combined_pattern.split(processed_text)
-    encoded_bytes = b''
+    parts = TAG_PATTERN.split(processed_text)
+    encoded_parts = []
 
     for i, part in enumerate(parts):
         if not part: continue
 
         if part in TAG_MAP:
-            encoded_bytes += TAG_MAP[part]
+            encoded_parts.append(TAG_MAP[part])
         elif part.startswith('<$') and part.endswith('$>'):
             hex_string = part[2:-2].strip().replace(" ", "")
-            encoded_bytes += bytes.fromhex(hex_string)
+            encoded_parts.append(bytes.fromhex(hex_string))
         else:
             try:
-                encoded_bytes += part.encode('shift_jis', errors='replace')
+                encoded_parts.append(part.encode('shift_jis', errors='replace'))
             except Exception as e:
                 print(f"WARNING: Could not encode part '{part[:20]}...': {e}")
     
-    return encoded_bytes + terminator
+    encoded_parts.append(terminator)
+    return b''.join(encoded_parts)
 
 # --- MAIN SCRIPT ---
 if not all(os.path.exists(f) for f in [rom_filename, translated_text_filename]):
@@ -114,42 +122,97 @@ else:
     # This will store the new location of every unique string
     repointed_locations = {}
 
-    # --- First Pass: Insert text and decide new locations ---
-    for entry in entries:
-        if entry["is_duplicate"]:
-            continue
-
+    # --- First Pass: Measure the original slots and encode the new text ---
+    unique_entries = [entry for entry in entries if not entry["is_duplicate"]]
+    entries_by_offset = sorted(unique_entries, key=lambda e: e["original_text_offset"])
+    # Going through the strings in ROM order, a string that starts before the last
+    # terminator found ends at that same terminator, so no byte is scanned twice
+    original_end = -1
+    for entry in entries_by_offset:
         original_offset = entry["original_text_offset"]
         
         # Get original text length
-        original_end = rom_data.find(terminator, original_offset)
-        original_length = (original_end - original_offset) + 1 if original_end != -1 else 0
+        if original_offset > original_end:
+            original_end = rom_data.find(terminator, original_offset)
+        entry["original_length"] = (original_end - original_offset) + 1 if original_end != -1 else 0
 
         # Encode new text to get its length
-        new_text_bytes = encode_string(entry["text"])
+        entry["new_text_bytes"] = encode_string(entry["text"])
+
+    # Strings that share bytes with another string (e.g. one is a suffix of the other)
+    # can't give their space away, since the other string may still be using it
+    shared_slot_ids = set()
+    last_entry = None
+    for entry in entries_by_offset:
+        entry_end = entry["original_text_offset"] + entry["original_length"]
+        if last_entry is not None:
+            last_end = last_entry["original_text_offset"] + last_entry["original_length"]
+            if entry["original_text_offset"] < last_end:
+                shared_slot_ids.update((entry["id"], last_entry["id"]))
+            if entry_end <= last_end:
+                continue
+        last_entry = entry
+
+    # --- Second Pass: Keep the strings that fit in place and collect the space left over ---
+    free_slots = []  # (length, offset) of reusable holes in the original text area
+    moved_entries = []
+    for entry in unique_entries:
+        original_offset = entry["original_text_offset"]
+        original_length = entry["original_length"]
+        new_text_bytes = entry["new_text_bytes"]
         new_length = len(new_text_bytes)
+        is_reusable = entry["id"] not in shared_slot_ids
+        if not is_reusable:
+            # A string sharing bytes with another may already have been cut short by that
+            # string's new text, so measure what is left of it now
+            current_end = rom_data.find(terminator, original_offset)
+            original_length = (current_end - original_offset) + 1 if current_end != -1 else 0
 
         if new_length <= original_length:
             # If it fits, it stays in the original location
             rom_data[original_offset : original_offset + new_length] = new_text_bytes
             # Fill the rest of the original space with terminators to prevent garbage data
-            for i in range(new_length, original_length):
-                rom_data[original_offset + i] = terminator[0]
+            rom_data[original_offset + new_length : original_offset + original_length] = terminator * (original_length - new_length)
             
             repointed_locations[entry["id"]] = original_offset
+            if is_reusable and new_length < original_length:
+                free_slots.append((original_length - new_length, original_offset + new_length))
         else:
-            # If it doesn't fit, move it to free space
+            # If it doesn't fit, it has to move and its whole original slot becomes free
+            moved_entries.append(entry)
+            if is_reusable and original_length > 0:
+                free_slots.append((original_length, original_offset))
+    free_slots.sort()
+
+    # --- Third Pass: Place moved strings, largest first, in the smallest hole that fits ---
+    reused_slot_count = 0
+    moved_entries.sort(key=lambda e: len(e["new_text_bytes"]), reverse=True)
+    for entry in moved_entries:
+        new_text_bytes = entry["new_text_bytes"]
+        new_length = len(new_text_bytes)
+
+        slot_index = bisect.bisect_left(free_slots, (new_length, 0))
+        if slot_index < len(free_slots):
+            slot_length, new_offset = free_slots.pop(slot_index)
+            if slot_length > new_length:
+                bisect.insort(free_slots, (slot_length - new_length, new_offset + new_length))
+            reused_slot_count += 1
+        else:
+            # No hole is big enough, move it to free space
             if current_free_space_offset + new_length > ROM_END_OFFSET:
                 print(f"FATAL ERROR: Ran out of free space! Aborting.")
                 exit()
             
-            rom_data[current_free_space_offset : current_free_space_offset + new_length] = new_text_bytes
-            repointed_locations[entry["id"]] = current_free_space_offset
+            new_offset = current_free_space_offset
             current_free_space_offset += new_length
 
+        rom_data[new_offset : new_offset + new_length] = new_text_bytes
+        repointed_locations[entry["id"]] = new_offset
+
+    print(f"Moved {len(moved_entries)} strings, {reused_slot_count} of them into space freed in the original text area.")
     print(f"Finished writing new text blocks. Last byte written at {hex(current_free_space_offset)}.")
 
-    # --- Second Pass: Update all pointers ---
+    # --- Fourth Pass: Update all pointers ---
     print("\nUpdating pointer table...")
     for entry in entries:
         pointer_offset = entry["pointer_offset"]
@@ -161,8 +224,7 @@ else:
         if target_id in repointed_locations:
             new_text_location = repointed_locations[target_id]
             new_pointer_value = 0x08000000 + new_text_location
-            new_pointer_bytes = struct.pack('<I', new_pointer_value)
-            rom_data[pointer_offset : pointer_offset + 4] = new_pointer_bytes
+            POINTER_STRUCT.pack_into(rom_data, pointer_offset, new_pointer_value)
         else:
             print(f"WARNING: Could not find original string for duplicate <STRING {entry['id']:04}>. Pointer not updated.")
 